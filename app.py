@@ -1,36 +1,86 @@
 # app.py
+import asyncio
 import os
+import concurrent.futures
 import secrets
+import signal
+import stat
 import shutil
-import subprocess
 import time
 import json
+from collections import OrderedDict
 from pathlib import Path
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify
+from quart import Quart, render_template, request, redirect, url_for, send_from_directory, jsonify
 
 import yaml
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+try:
+    import orjson
+
+    def dump_json(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    load_json = orjson.loads
+except ImportError:
+    def dump_json(obj):
+        return json.dumps(obj, indent=2).encode()
+
+    load_json = json.loads
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
 
 BASE_DIR = Path(__file__).resolve().parent
 SESSIONS_DIR = BASE_DIR / "sessions"
 SESSIONS_DIR.mkdir(exist_ok=True)
+# parallel hosts per ansible-playbook run, once an inventory holds more than one client
+ANSIBLE_FORKS = int(os.environ.get("ANSIBLE_FORKS", "50"))
+LOG_CHUNK_SIZE = 64 * 1024
+TAIL_BLOCK_SIZE = 64 * 1024
+# how many transfers each server process runs at once; further accepted sessions wait in its queue
+TRANSFER_WORKERS = int(os.environ.get("TRANSFER_WORKERS", "4"))
+META_CACHE_SIZE = 1024
+DEBUG = os.environ.get("APP_DEBUG") == "1"
+_meta_cache = OrderedDict()
+# extra environment for ansible-playbook runs, filled in once at startup
+_ansible_env = {}
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = secrets.token_urlsafe(16)
+app = Quart(__name__)
+# set SECRET_KEY when running several workers so they all share one key
+app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY") or secrets.token_urlsafe(16)
+# templates are only re-read from disk when debugging
+app.config['TEMPLATES_AUTO_RELOAD'] = DEBUG
 
 # Utility: create ephemeral ed25519 keypair
 def generate_ephemeral_keypair(session_path: Path):
     key_path = session_path / "id_ed25519"
     pub_path = session_path / "id_ed25519.pub"
-    # remove existing if any
-    if key_path.exists():
-        key_path.unlink()
-    if pub_path.exists():
-        pub_path.unlink()
-    cmd = ["ssh-keygen", "-t", "ed25519", "-f", str(key_path), "-N", ""]
-    subprocess.run(cmd, check=True)
-    pubkey = pub_path.read_text().strip()
+    # generated in-process instead of forking ssh-keygen
+    key = ed25519.Ed25519PrivateKey.generate()
+    priv_bytes = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption()
+    )
+    pubkey = key.public_key().public_bytes(
+        serialization.Encoding.OpenSSH,
+        serialization.PublicFormat.OpenSSH
+    ).decode()
+    # 0o600 keeps ssh from refusing the private key
+    write_synced(key_path, priv_bytes, 0o600)
+    write_synced(pub_path, (pubkey + "\n").encode(), 0o644)
     return str(key_path), pubkey
 
+def write_synced(path: Path, data, mode):
+    # O_TRUNC replaces any existing file; the fsync makes its contents durable
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
 def write_inventory(session_path: Path, host, user, private_key_path):
     inv = session_path / "inventory.ini"
     content = f"""[target]
@@ -47,56 +97,276 @@ def write_vars_file(session_path: Path, src_paths, dest_path, client_user, publi
         "client_user": client_user,
         "public_key": public_key
     }
-    varsf.write_text(yaml.safe_dump(data))
+    varsf.write_text(yaml.dump(data, Dumper=SafeDumper))
     return str(varsf)
 
+def _scan_dir(d):
+    # size of the regular files directly in d, plus the subdirectories to visit next
+    size = 0
+    subdirs = []
+    try:
+        with os.scandir(d) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return size, subdirs
+
+def flush_meta(session_path: Path, meta, durable=False):
+    # write-then-rename so readers never see a half-written meta.json
+    tmp = session_path / "meta.json.tmp"
+    if durable:
+        write_synced(tmp, dump_json(meta), 0o644)
+    else:
+        tmp.write_bytes(dump_json(meta))
+    os.replace(tmp, session_path / "meta.json")
+
+def fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def load_meta(session_path: Path):
+    # served from cache until flush_meta swaps in a new file (new inode/mtime)
+    path = session_path / "meta.json"
+    st = os.stat(path)
+    sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+    key = str(path)
+    hit = _meta_cache.get(key)
+    if hit is not None and hit[0] == sig:
+        _meta_cache.move_to_end(key)
+        meta = hit[1]
+    else:
+        meta = load_json(path.read_bytes())
+        _meta_cache[key] = (sig, meta)
+        _meta_cache.move_to_end(key)
+        if len(_meta_cache) > META_CACHE_SIZE:
+            _meta_cache.popitem(last=False)
+    # callers update meta in place, so hand out a copy
+    return dict(meta)
+
 def compute_total_size(paths):
     total = 0
+    dirs = []
     for p in paths:
-        if os.path.isfile(p):
-            total += os.path.getsize(p)
-        elif os.path.isdir(p):
-            for root, dirs, files in os.walk(p):
-                for f in files:
-                    fp = os.path.join(root, f)
-                    try:
-                        total += os.path.getsize(fp)
-                    except OSError:
-                        pass
+        # one stat gives both the type and the size
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append(p)
+        elif stat.S_ISREG(st.st_mode):
+            total += st.st_size
+    if not dirs:
+        return total
+    # scanning is stat/getdents bound and releases the GIL, so every directory
+    # found is fed back into the pool instead of walking each tree serially
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        pending = {pool.submit(_scan_dir, d) for d in dirs}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                size, subdirs = fut.result()
+                total += size
+                pending.update(pool.submit(_scan_dir, d) for d in subdirs)
     return total
 
-def run_ansible_playbook(inv_path, playbook_path, extra_vars_file, logfile_path):
+async def run_ansible_playbook(inv_path, playbook_path, extra_vars_file, logfile_path):
     # call ansible-playbook, capture stdout/stderr to logfile
     cmd = [
         "ansible-playbook",
         "-i", inv_path,
+        "-f", str(ANSIBLE_FORKS),
         str(playbook_path),
         "--extra-vars", f"@{extra_vars_file}"
     ]
-    with open(logfile_path, "wb") as logf:
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        for line in proc.stdout:
-            logf.write(line)
-            logf.flush()
-        proc.wait()
+    # unbuffered: every chunk is one write(2), visible to the status page at once
+    with open(logfile_path, "wb", buffering=0) as logf:
+        env = dict(_ansible_env, **os.environ)
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env, start_new_session=True)
+        try:
+            # copy in whole pipe-sized chunks rather than splitting into lines
+            while True:
+                chunk = await proc.stdout.read(LOG_CHUNK_SIZE)
+                if not chunk:
+                    break
+                logf.write(chunk)
+            await proc.wait()
+        except asyncio.CancelledError:
+            # don't leave ansible (or the ssh/rsync it forked) running after the
+            # worker has given up on it; they share the pipe, so kill the whole group
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+            raise
     return proc.returncode
 
+async def run_transfer(token):
+    session_path = SESSIONS_DIR / token
+    meta = load_meta(session_path)
+    inv_path = str(session_path / "inventory.ini")
+    vars_path = str(session_path / "vars.yml")
+    meta['status'] = 'starting_transfer'
+    # compute expected size
+    total_bytes = await asyncio.to_thread(compute_total_size, meta['src_paths'])
+    meta['expected_size_bytes'] = total_bytes
+    meta['started_at'] = time.time()
+    flush_meta(session_path, meta)
+
+    # run ansible transfer playbook
+    playbook_transfer = BASE_DIR / "playbooks" / "transfer.yml"
+    logfile = session_path / "ansible_transfer.log"
+    rc = await run_ansible_playbook(inv_path, playbook_transfer, vars_path, logfile)
+    meta['transfer_rc'] = rc
+    meta['transfer_logfile'] = str(logfile)
+    meta['finished_at'] = time.time()
+    if rc == 0:
+        meta['status'] = 'transfer_success'
+    else:
+        meta['status'] = 'transfer_failed'
+    flush_meta(session_path, meta)
+
+    # run cleanup to remove ephemeral public key from remote authorized_keys
+    playbook_cleanup = BASE_DIR / "playbooks" / "cleanup.yml"
+    logfile2 = session_path / "ansible_cleanup.log"
+    rc2 = await run_ansible_playbook(inv_path, playbook_cleanup, vars_path, logfile2)
+    meta['cleanup_rc'] = rc2
+    meta['cleanup_logfile'] = str(logfile2)
+    flush_meta(session_path, meta)
+    write_report(session_path, meta)
+
+def write_report(session_path: Path, meta):
+    # write a simple report
+    report = {
+        "token": meta['token'],
+        "status": meta['status'],
+        "src_paths": meta['src_paths'],
+        "dest_path": meta['dest_path'],
+        "client_host": meta['client_host'],
+        "client_user": meta['client_user'],
+        "expected_size_bytes": meta.get('expected_size_bytes'),
+        "started_at": meta.get('started_at'),
+        "finished_at": meta.get('finished_at'),
+        "transfer_rc": meta.get('transfer_rc'),
+        "cleanup_rc": meta.get('cleanup_rc')
+    }
+    if 'error' in meta:
+        report['error'] = meta['error']
+    (session_path / "report.json").write_bytes(dump_json(report))
+
+async def abort_transfer(token, status, error):
+    # the client may already trust our key, so still try to take it back out
+    session_path = SESSIONS_DIR / token
+    meta = load_meta(session_path)
+    meta['status'] = status
+    meta['error'] = error
+    meta['finished_at'] = time.time()
+    playbook_cleanup = BASE_DIR / "playbooks" / "cleanup.yml"
+    logfile2 = session_path / "ansible_cleanup.log"
+    try:
+        rc2 = await run_ansible_playbook(str(session_path / "inventory.ini"), playbook_cleanup, str(session_path / "vars.yml"), logfile2)
+    except Exception:
+        app.logger.exception("cleanup for session %s failed", token)
+        rc2 = None
+    # a cleanup_rc, even None, marks the session finished for the status page
+    meta['cleanup_rc'] = rc2
+    meta['cleanup_logfile'] = str(logfile2)
+    flush_meta(session_path, meta)
+    write_report(session_path, meta)
+
+async def transfer_worker(queue):
+    while True:
+        token = await queue.get()
+        try:
+            await run_transfer(token)
+        except asyncio.CancelledError:
+            await abort_transfer(token, 'interrupted', "server shut down during the transfer")
+            raise
+        except Exception as exc:
+            app.logger.exception("transfer for session %s failed", token)
+            try:
+                await abort_transfer(token, 'error', str(exc) or type(exc).__name__)
+            except Exception:
+                app.logger.exception("could not record failure for session %s", token)
+        finally:
+            queue.task_done()
+
+@app.before_serving
+async def detect_ansible_pipelining():
+    # pipelining runs modules over the open ssh session instead of copying them
+    # over first. An env var would override ansible.cfg, so only turn it on when
+    # no config file (or env var) already sets it, e.g. to False for requiretty.
+    out = b""
+    for cmd in (["ansible-config", "dump", "--only-changed", "-t", "all"],
+                ["ansible-config", "dump", "--only-changed"]):
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        except OSError:
+            break
+        out, _ = await proc.communicate()
+        if proc.returncode == 0:
+            break
+    if b"pipelining" not in out.lower():
+        _ansible_env["ANSIBLE_PIPELINING"] = "True"
+
+@app.before_serving
+async def preload_templates():
+    # compile every template once up front instead of on its first request
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+@app.before_serving
+async def start_transfer_workers():
+    app.transfer_queue = asyncio.Queue()
+    app.transfer_workers = [
+        asyncio.create_task(transfer_worker(app.transfer_queue))
+        for _ in range(TRANSFER_WORKERS)
+    ]
+
+@app.after_serving
+async def stop_transfer_workers():
+    # sessions still waiting in the queue never started; let the client submit again
+    while not app.transfer_queue.empty():
+        token = app.transfer_queue.get_nowait()
+        session_path = SESSIONS_DIR / token
+        meta = load_meta(session_path)
+        meta['status'] = 'waiting_for_client'
+        flush_meta(session_path, meta)
+        app.transfer_queue.task_done()
+    # running transfers are cancelled and run their cleanup before exiting
+    for task in app.transfer_workers:
+        task.cancel()
+    await asyncio.gather(*app.transfer_workers, return_exceptions=True)
+
 @app.route("/")
-def index():
+async def index():
     # simple UI: enter comma-separated src paths and dest path
-    return render_template("index.html")
+    return await render_template("index.html")
 
 @app.route("/create_session", methods=["POST"])
-def create_session():
+async def create_session():
     # src_paths text, dest_path, optional note
-    src_text = request.form.get("src_paths", "").strip()
-    dest_path = request.form.get("dest_path", "/home/ubuntu/received_files").strip()
+    form = await request.form
+    src_text = form.get("src_paths", "").strip()
+    dest_path = form.get("dest_path", "/home/ubuntu/received_files").strip()
     if not src_text:
         return "Please provide source paths (comma-separated)", 400
     src_paths = [s.strip() for s in src_text.split(",") if s.strip()]
     token = secrets.token_urlsafe(12)
     session_path = SESSIONS_DIR / token
-    session_path.mkdir(parents=True, exist_ok=False)
+    # private to the server user from the start; holds the session's ssh key
+    session_path.mkdir(mode=0o700)
     # store meta
     meta = {
         "token": token,
@@ -105,113 +375,91 @@ def create_session():
         "dest_path": dest_path,
         "status": "waiting_for_client"
     }
-    (session_path / "meta.json").write_text(json.dumps(meta, indent=2))
     # generate ephemeral keypair
-    priv_key_path, pubkey = generate_ephemeral_keypair(session_path)
+    priv_key_path, pubkey = await asyncio.to_thread(generate_ephemeral_keypair, session_path)
     # save public key in meta
     meta['public_key'] = pubkey
-    (session_path / "meta.json").write_text(json.dumps(meta, indent=2))
-    share_link = request.host_url.rstrip("/") + url_for("accept", token=token)
+    # the key files and meta.json are fsynced as they are written; one directory
+    # sync then makes their names durable too. All of it runs off the event loop.
+    await asyncio.to_thread(flush_meta, session_path, meta, durable=True)
+    await asyncio.to_thread(fsync_dir, session_path)
     return redirect(url_for("share", token=token))
 
 @app.route("/share/<token>")
-def share(token):
+async def share(token):
     session_path = SESSIONS_DIR / token
     if not session_path.exists():
         return "Invalid token", 404
-    meta = json.loads((session_path / "meta.json").read_text())
+    meta = load_meta(session_path)
     public_key = meta.get("public_key", "")
     # show link + public key to paste on client's machine
-    accept_url = request.host_url.rstrip("/") + url_for("accept", token=token)
-    return render_template("share.html", token=token, accept_url=accept_url, public_key=public_key)
+    accept_url = url_for("accept", token=token, _external=True)
+    return await render_template("share.html", token=token, accept_url=accept_url, public_key=public_key)
 
 @app.route("/accept/<token>", methods=["GET","POST"])
-def accept(token):
+async def accept(token):
     session_path = SESSIONS_DIR / token
     if not session_path.exists():
         return "Invalid or expired token", 404
-    meta = json.loads((session_path / "meta.json").read_text())
+    meta = load_meta(session_path)
     if request.method == "GET":
         # show public key + instructions for client to add public key to their ~/.ssh/authorized_keys
-        return render_template("accept.html", token=token, public_key=meta.get("public_key",""), dest_path=meta.get("dest_path","/home/ubuntu/received_files"))
+        return await render_template("accept.html", token=token, public_key=meta.get("public_key",""), dest_path=meta.get("dest_path","/home/ubuntu/received_files"))
     # POST: client submitted host and user -> trigger ansible
-    client_host = request.form.get("client_host").strip()
-    client_user = request.form.get("client_user").strip()
-    dest_path = request.form.get("dest_path").strip() or meta.get("dest_path")
+    form = await request.form
+    # re-read after the await so a second submit sees the first one's status
+    meta = load_meta(session_path)
+    if meta.get('status') != 'waiting_for_client':
+        return "A transfer has already been started for this session", 409
+    client_host = form.get("client_host").strip()
+    client_user = form.get("client_user").strip()
+    dest_path = form.get("dest_path").strip() or meta.get("dest_path")
     if not client_host or not client_user:
         return "Provide client_host and client_user", 400
     # update meta
     meta['client_host'] = client_host
     meta['client_user'] = client_user
     meta['dest_path'] = dest_path
-    meta['status'] = 'starting_transfer'
-    (session_path / "meta.json").write_text(json.dumps(meta, indent=2))
+    meta['status'] = 'queued'
 
     priv_key = str(session_path / "id_ed25519")
-    inv_path = write_inventory(session_path, client_host, client_user, priv_key)
-    vars_path = write_vars_file(session_path, meta['src_paths'], dest_path, client_user, meta['public_key'])
-    # compute expected size
-    total_bytes = compute_total_size(meta['src_paths'])
-    meta['expected_size_bytes'] = total_bytes
-    meta['started_at'] = time.time()
-    (session_path / "meta.json").write_text(json.dumps(meta, indent=2))
-
-    # run ansible transfer playbook
-    playbook_transfer = BASE_DIR / "playbooks" / "transfer.yml"
-    logfile = session_path / "ansible_transfer.log"
-    rc = run_ansible_playbook(inv_path, playbook_transfer, vars_path, logfile)
-    meta['transfer_rc'] = rc
-    meta['transfer_logfile'] = str(logfile)
-    meta['finished_at'] = time.time()
-    if rc == 0:
-        meta['status'] = 'transfer_success'
-    else:
-        meta['status'] = 'transfer_failed'
-    (session_path / "meta.json").write_text(json.dumps(meta, indent=2))
-
-    # run cleanup to remove ephemeral public key from remote authorized_keys
-    playbook_cleanup = BASE_DIR / "playbooks" / "cleanup.yml"
-    logfile2 = session_path / "ansible_cleanup.log"
-    rc2 = run_ansible_playbook(inv_path, playbook_cleanup, vars_path, logfile2)
-    meta['cleanup_rc'] = rc2
-    meta['cleanup_logfile'] = str(logfile2)
-    (session_path / "meta.json").write_text(json.dumps(meta, indent=2))
-
-    # write a simple report
-    report = {
-        "token": token,
-        "status": meta['status'],
-        "src_paths": meta['src_paths'],
-        "dest_path": dest_path,
-        "client_host": client_host,
-        "client_user": client_user,
-        "expected_size_bytes": total_bytes,
-        "started_at": meta['started_at'],
-        "finished_at": meta['finished_at'],
-        "transfer_rc": meta.get('transfer_rc'),
-        "cleanup_rc": meta.get('cleanup_rc')
-    }
-    (session_path / "report.json").write_text(json.dumps(report, indent=2))
+    write_inventory(session_path, client_host, client_user, priv_key)
+    write_vars_file(session_path, meta['src_paths'], dest_path, client_user, meta['public_key'])
+    flush_meta(session_path, meta)
 
+    # the transfer itself runs on a worker; the status page shows its progress
+    app.transfer_queue.put_nowait(token)
     return redirect(url_for("status", token=token))
 
 @app.route("/status/<token>")
-def status(token):
+async def status(token):
     session_path = SESSIONS_DIR / token
     if not session_path.exists():
         return "Invalid token", 404
-    meta = json.loads((session_path / "meta.json").read_text())
+    meta = load_meta(session_path)
     # show meta + tail of ansible log
     def tail(filename, n=200):
         p = session_path / filename
-        if not p.exists():
+        try:
+            fd = os.open(p, os.O_RDONLY)
+        except FileNotFoundError:
             return ""
-        data = p.read_text(errors='ignore').splitlines()
-        return "\n".join(data[-n:])
+        # read backwards from the end until n full lines are in hand
+        try:
+            pos = os.fstat(fd).st_size
+            data = b""
+            while pos > 0 and data.count(b"\n") <= n:
+                step = min(TAIL_BLOCK_SIZE, pos)
+                pos -= step
+                data = os.pread(fd, step, pos) + data
+        finally:
+            os.close(fd)
+        lines = data.decode(errors='ignore').splitlines()
+        return "\n".join(lines[-n:])
     transfer_log = tail("ansible_transfer.log")
     cleanup_log = tail("ansible_cleanup.log")
     report = session_path.joinpath("report.json").read_text() if (session_path / "report.json").exists() else "{}"
-    return render_template("status.html", meta=meta, transfer_log=transfer_log, cleanup_log=cleanup_log, report=report)
+    return await render_template("status.html", meta=meta, transfer_log=transfer_log, cleanup_log=cleanup_log, report=report)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=DEBUG)
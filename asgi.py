@@ -0,0 +1,4 @@
+# asgi.py
+# entry point for ASGI servers, e.g.
+#   gunicorn -k uvicorn_worker.UvicornWorker -w $(nproc) -b 0.0.0.0:5000 asgi:app
+from app import app